@@ -3,22 +3,47 @@ A simple script to walk a directory tree and transcode (`lame`, `faad`) audio fi
 tree.
 """
 import argparse
+import errno
+import itertools
 import logging
+import math
 import multiprocessing as mp
 import os
-import pathlib
+import shlex
 import shutil
+import struct
 import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
 LAME_EXE = 'lame'
-LAME_EXT = ('.mp3', '.wav')
+LAME_EXT = frozenset({'.mp3', '.wav'})
 FAAD_EXE = 'faad'
-FAAD_EXT = ('.m4a',)
-TRANS_EXT = LAME_EXT + FAAD_EXT # transcodable extensions
-IMAGE_EXT = ('.jpg', '.png', '.pdf')
+FAAD_EXT = frozenset({'.m4a'})
+TRANS_EXT = LAME_EXT | FAAD_EXT # transcodable extensions
+IMAGE_EXT = frozenset({'.jpg', '.png', '.pdf'})
+# outputs are written as a hidden .<name>.<pid>.lame_walker.wrk, and renamed once they're complete
+WRK_EXT = '.lame_walker.wrk'
+# how much older than its input an output can look and still count as done: FAT (e.g. a phone's
+# SD card) rounds mtimes down to 2 s, so a copy's mtime can't always match its input's exactly
+MTIME_SLACK_NS = 2 * 10**9
+
+# rough average bitrates (kbps) of lame's -V 0 ... -V 9 and --preset settings, from the lame docs
+LAME_VBR_KBPS = (245, 225, 190, 175, 165, 130, 115, 100, 85, 65)
+LAME_PRESET_KBPS = {'medium': 165, 'standard': 190, 'extreme': 245, 'insane': 320}
+
+# work items are small (action, ifn, ofn, args) tuples of plain str
+CMD = 0
+PIPE = 1  # args is (decoder args, encoder args); the decoder's stdout feeds the encoder
+REENCODE = 2  # args is (kbps, encoder args); inputs already at or under kbps are copied instead
+COPY = 3
+
+# the transcoders' stdin (and stdout, when they write to a file), shared by all of them instead of
+# subprocess opening and closing /dev/null for every child
+DEVNULL = os.open(os.devnull, os.O_RDWR)
 
 
 logging.basicConfig(
@@ -28,116 +53,483 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
-def worker_init():
-    pass
+def target_kbps(lame_args):
+    """Estimate the average bitrate (kbps) `lame` encodes at with `lame_args`, or None."""
+    vbr = cbr = None
+    it = iter(lame_args)
+    for arg in it:
+        try:
+            if arg.startswith('-V'):
+                q = float(arg[2:] or next(it))
+                if q < 0:
+                    raise ValueError(f"bad -V {q}")
+                vbr = LAME_VBR_KBPS[min(math.ceil(q), 9)]  # lame takes fractions up to 9.999
+            elif '--abr' == arg:
+                vbr = int(next(it))
+            elif '--preset' == arg:
+                preset = next(it)
+                vbr = LAME_PRESET_KBPS.get(preset) or int(preset)
+            elif '-b' == arg:  # the minimum bitrate for VBR/ABR, otherwise CBR
+                cbr = int(next(it))
+        except (ValueError, IndexError, StopIteration):
+            return None
+
+    return vbr or cbr
+
+
+def mp3_kbps(fn):
+    """
+    Return the average bitrate (kbps) of the MP3 file `fn`, or None if we can't tell.
+
+    This reads the first frame header, along with the Xing/Info or VBRI header VBR encoders put
+    in the first frame, so it only costs reading the first few KB of the file. Without one of
+    those headers, the first frame's bitrate is only trusted if the next few frames agree.
+    """
+    try:
+        with open(fn, 'rb') as f:
+            start = 0
+            head = f.read(10)
+            if 10 == len(head) and b'ID3' == head[:3]:
+                # skip the ID3v2 tag; its size is a 28 bit "syncsafe" int, and excludes the header
+                # (and footer, if there is one)
+                size = 0
+                for b in head[6:10]:
+                    size = (size << 7) | (b & 0x7f)
+                start = size + (20 if head[5] & 0x10 else 10)
+
+            f.seek(start)
+            buf = f.read(16384)
+            file_size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None  # so we re-encode, and if the file's unreadable, lame will tell us
+
+    for i in range(len(buf) - 3):
+        if 0xff != buf[i] or 0xe0 != buf[i + 1] & 0xe0:
+            continue
+
+        version = (buf[i + 1] >> 3) & 3  # 3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5
+        layer = (buf[i + 1] >> 1) & 3  # 1: layer III
+        br_idx = buf[i + 2] >> 4
+        sr_idx = (buf[i + 2] >> 2) & 3
+        if 1 == version or 1 != layer or br_idx in (0, 15) or 3 == sr_idx:
+            continue  # not a layer III frame header, or one we can't use
+
+        mono = 3 == buf[i + 3] >> 6
+        if 3 == version:
+            kbps = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)[br_idx - 1]
+            rate = (44100, 48000, 32000)[sr_idx]
+            samples, side_info = 1152, 17 if mono else 32
+        else:
+            kbps = (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)[br_idx - 1]
+            rate = (22050, 24000, 16000)[sr_idx] // (1 if 2 == version else 2)
+            samples, side_info = 576, 9 if mono else 17
+
+        frames = nbytes = None
+        xing = i + 4 + side_info
+        if buf[xing:xing + 4] in (b'Xing', b'Info') and len(buf) >= xing + 16:
+            flags, = struct.unpack_from('>I', buf, xing + 4)
+            fields = iter(struct.unpack_from('>II', buf, xing + 8))
+            if flags & 1:
+                frames = next(fields)
+            if flags & 2:
+                nbytes = next(fields)
+        elif b'VBRI' == buf[i + 36:i + 40] and len(buf) >= i + 54:
+            nbytes, frames = struct.unpack_from('>II', buf, i + 46)
+
+        if frames:
+            nbytes = nbytes or file_size - start - i
+            return nbytes * 8 * rate / (frames * samples * 1000)
+
+        # no header to go on: it's CBR, or VBR from an encoder that doesn't write one (and whose
+        # first frames are often low bitrate silence), so only trust kbps if the next few frames
+        # have the same bitrate, version, layer and sample rate. A frame is samples / 8 * bitrate /
+        # sample rate bytes long, plus a byte if its padding bit is set.
+        j = i
+        n = 0
+        while n < 8 and j + 3 < len(buf):
+            if 0xff != buf[j] or buf[i + 1] != buf[j + 1] or buf[i + 2] & 0xfc != buf[j + 2] & 0xfc:
+                return None  # a different bitrate, or not a frame where one should be
+            j += samples // 8 * kbps * 1000 // rate + ((buf[j + 2] >> 1) & 1)
+            n += 1
+
+        return kbps if n >= 4 else None
+
+    return None
+
+
+def copy_file(ifn, ofn):
+    """Copy the contents of `ifn` to `ofn`, in the kernel if we can."""
+    if hasattr(os, 'copy_file_range'):
+        # copies without going through user space, and can share extents (reflink) on btrfs/XFS
+        try:
+            with open(ifn, 'rb') as fsrc, open(ofn, 'wb') as fdst:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+            return
+        except OSError as e:
+            # e.g. across filesystems on some kernels, or not supported by the filesystem
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    shutil.copyfile(ifn, ofn)  # sendfile where it can, else a read/write loop
+
+
+def prefetch(fn):
+    """Ask the kernel to start reading all of `fn` into the page cache, without waiting for it."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open(fn, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass  # just a hint; if the file's unreadable, the transcoder will tell us
+
+
+def wrk_path(ofn):
+    """The temporary name `ofn` is written under, which can't collide with an input's output."""
+    d, name = os.path.split(ofn)
+    return os.path.join(d, f'.{name}.{os.getpid()}{WRK_EXT}')
+
+
+def is_stale_wrk(e):
+    """
+    Whether the output dir entry `e` is a temporary file left behind by a run that was killed.
+
+    The pid in the name tells us whether the run that wrote it is still going (e.g. another run
+    into the same outdir), in which case it's left alone.
+    """
+    if not e.name.startswith('.') or not e.name.endswith(WRK_EXT) \
+            or not e.is_file(follow_symlinks=False):
+        return False
+
+    try:
+        pid = int(e.name[:-len(WRK_EXT)].rsplit('.', 1)[-1])
+    except ValueError:
+        return False  # not one of ours
+
+    if os.getpid() == pid or 'posix' != os.name:
+        return True  # nothing of ours writes to a dir until we've listed it
+
+    try:
+        os.kill(pid, 0)  # just checks that pid exists
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass  # e.g. EPERM: it exists, but isn't ours to signal
+
+    return False
+
+
+def log_failed(returncode, args, stderr):
+    msgf = "cmd failed (%d): %s"
+    vals = [returncode, ' '.join(args)]
+    if stderr:
+        msgf = msgf + '\n -> stderr: %s'
+        vals.append(stderr.decode())
+    log.error(msgf, *vals)
 
 
 def worker(work):
-    ofn = work['ofn']
-    if ofn.exists():
-        work['returncode'] = 0  # kinda cheesy, but w/e
-        return work
+    action, ifn, ofn, args = work
+    wrk = wrk_path(ofn)  # args already write here
+    if COPY != action:
+        # read the whole input in one go, rather than in small reads that interleave (and seek)
+        # with the other workers' encoders
+        prefetch(ifn)
+
+    if REENCODE == action:
+        # re-encoding can't make a low bitrate file sound any better, and likely won't make it
+        # much smaller either
+        kbps, args = args
+        in_kbps = mp3_kbps(ifn)
+        action = COPY if in_kbps is not None and in_kbps <= kbps else CMD
+
+    if CMD == action:
+        # the transcoders write their output to a file, so only stderr is worth a pipe; we hold
+        # no inheritable fds, so there's no need to pay for closing them in the child either
+        p = subprocess.run(args, stdin=DEVNULL, stdout=DEVNULL, stderr=subprocess.PIPE,
+                           close_fds=False)
 
-    ifn = work['ifn']
-    if 'cmd' == work['action']:
-        p = subprocess.run(work['args'], capture_output=True)
-
-        work['returncode'] = p.returncode
         if 0 != p.returncode:
-            work['stdout'] = p.stdout
-            work['stderr'] = p.stderr
+            log_failed(p.returncode, args, p.stderr)
+
+        returncode = p.returncode
+
+    elif PIPE == action:
+        # stream the decoded PCM straight into the encoder, instead of a big intermediate .wav
+        dec_args, enc_args = args
+        # dec's stderr goes to a file, as nothing reads a pipe from it until enc is done; a
+        # chatty dec would fill that pipe and block, with enc waiting on it
+        with tempfile.TemporaryFile() as dec_errf:
+            dec = subprocess.Popen(dec_args, stdin=DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=dec_errf, close_fds=False)
+            try:
+                enc = subprocess.Popen(enc_args, stdin=dec.stdout, stdout=DEVNULL,
+                                       stderr=subprocess.PIPE, close_fds=False)
+            except BaseException:
+                dec.kill()
+                dec.wait()
+                raise
+            finally:
+                dec.stdout.close()  # so dec sees a broken pipe if enc dies
+
+            _, enc_err = enc.communicate()
+            dec.wait()
+            dec_errf.seek(0)
+            dec_err = dec_errf.read()
+
+        for p, p_args, p_err in ((dec, dec_args, dec_err), (enc, enc_args, enc_err)):
+            if 0 != p.returncode:
+                log_failed(p.returncode, p_args, p_err)
+
+        returncode = dec.returncode or enc.returncode
+
+    elif COPY == action:
+        # we only want to keep the timestamps, so skip the rest of the copystat syscalls copy2
+        # would do
+        copy_file(ifn, wrk)
+        st = os.stat(ifn)
+        os.utime(wrk, ns=(st.st_atime_ns, st.st_mtime_ns))
+        returncode = 0  # kinda cheesy, as copy_file could raise
 
-            msgf = "cmd failed (%d): %s"
-            vals = [work['returncode'], ' '.join(work['args'])]
-            for out in ('stdout','stderr'):
-                if work[out]:
-                    msgf = msgf + f'\n -> {out}: %s'
-                    vals.append(work[out].decode())
-            log.error(msgf, *vals)
+    else:
+        raise RuntimeError(f"unknown action {action}")
+
+    # only complete files get the real name, so an interrupted or failed run can't leave behind a
+    # partial output that looks finished next time
+    if 0 == returncode:
+        try:
+            os.replace(wrk, ofn)
+        except FileNotFoundError:
+            log.error("%s vanished before it could be renamed to %s", wrk, ofn)
+            returncode = 1
+    else:
+        try:
+            os.unlink(wrk)
+        except FileNotFoundError:
+            pass
 
-    elif 'copy' == work['action']:
-        shutil.copy2(ifn, ofn)
-        work['returncode'] = 0  # similarly cheesy, as copy2 could raise
+    return returncode
+
+
+def counted(work, bar):
+    """Yield from `work`, adding each item to the total of the tqdm `bar`."""
+    bar.total = 0
+    for w in work:
+        bar.total += 1
+        yield w
 
-    else:
-        raise RuntimeError(f"unknown action {work['action']}")
 
-    return work
+def walk(root, exts=None):
+    """
+    Yield the `os.DirEntry` of every regular file below `root`, following links.
+
+    If `exts` is given, only files with one of those (lowercase) extensions are yielded.
+    """
+    try:
+        it = os.scandir(root)
+    except OSError as e:
+        log.warning("Skipping %s (%s)", root, e.strerror)
+        return
+
+    with it:
+        for e in it:
+            # both use the d_type readdir hands back, so no stat unless e is a link
+            if e.is_dir():
+                yield from walk(e.path, exts)
+            elif not e.is_file():
+                log.debug("Skipping %s (not a regular file)", e.path)
+            elif exts is None or os.path.splitext(e.name)[1].lower() in exts:
+                yield e
 
 
 def main(args):
     # sanity check inputs
-    indir = pathlib.Path(args.indir)
-    if not indir.is_dir():
+    indir = os.path.normpath(args.indir)
+    if not os.path.isdir(indir):
         raise ValueError(f"indir {args.indir} does not exist")
 
-    outdir = pathlib.Path(args.outdir)
+    outdir = os.path.normpath(args.outdir)
     if indir == outdir:
         raise ValueError(f"outdir cannot be the same as indir")
 
-    outdir.mkdir(exist_ok=True)
+    os.makedirs(outdir, exist_ok=True)
+
+    # look the transcoders up on PATH once, instead of exec searching PATH for every file
+    exes = {}
+    for exe in (LAME_EXE, FAAD_EXE):
+        exes[exe] = shutil.which(exe)
+        if exes[exe] is None:
+            log.warning("%s not found on PATH", exe)
+            exes[exe] = exe
+
+    # constant argv prefixes, so building each file's args is a single tuple concat
+    lame_args = args.lame_args
+    lame_cmd = (exes[LAME_EXE], '--quiet', *lame_args)
+    faad_cmd = (exes[FAAD_EXE], '--quiet', '--stdio')
+
+    copy_kbps = args.target_bitrate
+    if copy_kbps is None:
+        copy_kbps = target_kbps(lame_args)
+
+    # extension -> action, so classifying a file is a single dict lookup
+    ext_actions = dict.fromkeys(LAME_EXT, CMD)
+    ext_actions.update(dict.fromkeys(FAAD_EXT, PIPE))
+    if copy_kbps:
+        log.debug("Copying .mp3 files at or below %d kbps instead of re-encoding", copy_kbps)
+        ext_actions['.mp3'] = REENCODE
+
+    # an output path is its input path with the indir prefix swapped for outdir
+    in_prefix_len = len(os.path.join(indir, ''))
+    out_prefix = os.path.join(outdir, '')
+
+    # generate tuples describing the work to do
+    def gen_work(all_files):
+        # output dir -> {name: DirEntry} of what's already in it (None if the dir doesn't exist),
+        # so we list each output dir once, instead of a stat per file
+        out_dirs = {}
+        # the outputs we've already claimed, e.g. so song.mp3 and song.wav don't both write
+        # song.mp3
+        seen = set()
+
+        # this loop runs once per file, so look these up once
+        splitext, split, get_action = os.path.splitext, os.path.split, ext_actions.get
+
+        for ifn, mtime_ns in all_files:
+            ofn = out_prefix + ifn[in_prefix_len:]
+            base, ext = splitext(ofn)
+            action = get_action(ext.lower(), COPY)
+            if COPY == action:
+                work = (COPY, ifn, ofn, None)
 
-    log.debug("Scanning input directory")
-    # all directories (or links to dirs) in input
-    all_dirs = []
+            else:
+                ofn = base + '.mp3'
+                wrk = wrk_path(ofn)
+                if CMD == action:
+                    work = (CMD, ifn, ofn, lame_cmd + (ifn, wrk))
+                elif PIPE == action:
+                    work = (PIPE, ifn, ofn, (faad_cmd + (ifn,), lame_cmd + ('-', wrk)))
+                else:
+                    work = (REENCODE, ifn, ofn, (copy_kbps, lame_cmd + (ifn, wrk)))
+
+            if ofn in seen:
+                log.warning("Skipping %s (%s is already made from another input)", ifn, ofn)
+                continue
+            seen.add(ofn)
+
+            d, name = split(ofn)
+            if d not in out_dirs:
+                try:
+                    with os.scandir(d) as it:
+                        existing = {}
+                        for e in it:
+                            if not is_stale_wrk(e):
+                                existing[e.name] = e
+                                continue
+
+                            log.debug("Removing stale %s", e.path)
+                            try:
+                                os.unlink(e.path)
+                            except OSError as err:
+                                log.warning("Couldn't remove stale %s (%s)", e.path, err.strerror)
+                    out_dirs[d] = existing
+                except FileNotFoundError:
+                    out_dirs[d] = None
+
+            existing = out_dirs[d]
+            if existing is None:
+                # make the output tree as we go, only where we'll actually write, once per dir
+                os.makedirs(d, exist_ok=True)
+                out_dirs[d] = {}
 
-    # all files to xcode/copy
-    all_files = []
+            else:
+                # skip finished files here, so they never cost a trip through the pool. An output
+                # older than its input is stale (e.g. the input was retagged), so that gets redone.
+                e = existing.get(name)
+                if e is not None and e.stat().st_mtime_ns + MTIME_SLACK_NS >= mtime_ns:
+                    continue
+
+            yield work
 
-    for root, _, files in os.walk(indir, followlinks=True):
-        root = pathlib.Path(root)
+    # with --media-only, don't even stat the files we won't transcode/copy
+    exts = TRANS_EXT | IMAGE_EXT if args.media_only else None
 
-        if root != indir:
-            dir = root.relative_to(indir)
-            all_dirs.append(dir)
+    if args.stream:
+        log.debug("Scanning input directory while transcoding")
+        # hand files to the pool as soon as the walk finds them. Transcodes and copies come out of
+        # the walk mixed together, so only batch them if asked to.
+        all_files = ((e.path, e.stat().st_mtime_ns) for e in walk(indir, exts))
+        tasks = [(gen_work(all_files), args.chunksize or 1)]
+        total = None
 
-        for fn in files:
-            fn = pathlib.Path(root/fn).relative_to(indir)
-            all_files.append(fn)
+    else:
+        log.debug("Scanning input directory")
+        # all files to xcode/copy, largest first: a big file picked up last would keep one worker
+        # busy while the rest sit idle
+        all_files = []
+        for e in walk(indir, exts):
+            st = e.stat()
+            all_files.append((st.st_size, e.path, st.st_mtime_ns))
+        all_files.sort(reverse=True)
+        all_work = list(gen_work((ifn, mtime_ns) for _, ifn, mtime_ns in all_files))
+        log.debug("%d of %d files to do", len(all_work), len(all_files))
+
+        # transcodes go out one at a time (and first), so the size ordering is kept and the
+        # per-item pool overhead is dwarfed by the transcode. Copies are cheap, so batch them to
+        # cut the pool's per-task overhead, but keep the batches small enough that the progress
+        # bar still moves smoothly.
+        cmd_work = [w for w in all_work if COPY != w[0]]
+        copy_work = [w for w in all_work if COPY == w[0]]
+
+        chunksize = args.chunksize
+        if chunksize is None:
+            chunksize = max(1, min(32, len(copy_work) // (args.num_workers * 4)))
+
+        tasks = [(cmd_work, 1), (copy_work, chunksize)]
+        total = len(all_work)
+
+    if args.nice:
+        # lame/faad inherit our niceness, so a long run leaves the machine usable
+        os.nice(args.nice)
 
-    log.debug("Making output tree")
-    for d in all_dirs:
-        d = outdir/d
-        d.mkdir(parents=True, exist_ok=True)
+    log.debug("Transcoding")
+    # The workers spend their time waiting on lame/faad (or in a copy syscall), which releases the
+    # GIL, so threads do the job without extra interpreters or pickling the work. Redrawing the
+    # bar per item shows up in profiles on copy-heavy runs, so redraw at most twice a second and
+    # every ~0.1% of the work.
+    with ThreadPool(args.num_workers) as pool, logging_redirect_tqdm(),\
+         tqdm.tqdm(total=total, mininterval=0.5, miniters=max(1, (total or 0) // 1000),
+                   smoothing=0) as bar:
+        if total is None:
+            # still scanning, so grow the total as the scan finds more to do
+            tasks = [(counted(work, bar), cs) for work, cs in tasks]
+
+        # queue everything up front, so idle workers move on to the copies during the last
+        # transcodes
+        it = itertools.chain(*[
+            pool.imap_unordered(worker, work, chunksize=cs) for work, cs in tasks])
+        for _ in it:
+            bar.update()
 
-    # generate dicts describing the work to do
-    def gen_work(all_files):
-        for fn in all_files:
-            work = {}
-            ifn = indir / fn
-            work['ifn'] = ifn
-
-            ofn = outdir / fn
-            if ifn.suffix in LAME_EXT:
-                ofn = ofn.with_suffix('.mp3')
-                work.update(
-                    action='cmd',
-                    ofn=ofn,
-                    args=(LAME_EXE, '--quiet', *args.lame_args.split(), str(ifn), str(ofn)),
-                )
-
-            elif ifn.suffix in FAAD_EXT:
-                ofn = ofn.with_suffix('.wav')
-                work.update(
-                    action='cmd',
-                    ofn=ofn,
-                    args=(FAAD_EXE, '--quiet', '-o', str(ofn), ifn),
-                )
 
-            else:
-                work.update(ofn=ofn, action='copy')
+def positive_int(s):
+    """argparse type for ints >= 1."""
+    n = int(s)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {n}")
+    return n
 
-            yield work
 
-    log.debug("Transcoding")
-    with mp.Pool(args.num_workers,
-                 initializer=worker_init,
-                 initargs=tuple()) as pool,\
-         logging_redirect_tqdm():
-        it = pool.imap_unordered(worker, gen_work(all_files), chunksize=1)
-        it = tqdm.tqdm(it, total=len(all_files))
-        for _ in it:
-            pass
+def non_negative_int(s):
+    """argparse type for ints >= 0."""
+    n = int(s)
+    if n < 0:
+        raise argparse.ArgumentTypeError(f"must be at least 0, not {n}")
+    return n
 
 
 if __name__ == '__main__':
@@ -152,12 +544,33 @@ if __name__ == '__main__':
                         help='The directory of output MP3 files.')
 
     parser.add_argument('--num-workers', type=int, default=mp.cpu_count(),
-                        help='The number of worker processes to run simultaneously.')
+                        help='The number of files to transcode/copy simultaneously.')
+
+    parser.add_argument('--nice', type=non_negative_int, default=0,
+                        help='Lower the CPU priority of the transcoders by this much '
+                             '(see nice(1)).')
+
+    parser.add_argument('--chunksize', type=positive_int, default=None,
+                        help='The number of files handed to a worker at once when copying, or '
+                             'for every file with --stream (default: picked from the number of '
+                             'files and workers, or 1 with --stream).')
+
+    parser.add_argument('--stream', action='store_true',
+                        help='Start transcoding while the input tree is still being scanned, '
+                             'instead of scanning first and doing the largest files first.')
+
+    parser.add_argument('--media-only', action='store_true',
+                        help='Only copy images to the output tree, not every other file.')
+
+    #parser.add_argument('--lame-args', type=shlex.split, default='--abr 128 -b 64',
+    #parser.add_argument('--lame-args', type=shlex.split, default='--preset medium',
+    parser.add_argument('--lame-args', type=shlex.split, default='-V 7',
+                        help='The optional arguments passed to `lame` (split like a shell would).')
 
-    #parser.add_argument('--lame-args', type=str, default='--abr 128 -b 64',
-    #parser.add_argument('--lame-args', type=str, default='--preset medium',
-    parser.add_argument('--lame-args', type=str, default='-V 7',
-                        help='The optional arguments pased to `lame`.')
+    parser.add_argument('--target-bitrate', type=int, default=None,
+                        help='Copy .mp3 files at or below this bitrate (kbps) instead of '
+                             're-encoding them (default: estimated from --lame-args; 0 to '
+                             'always re-encode).')
 
     args = parser.parse_args()
     main(args)